@@ -1,17 +1,28 @@
 import os
 import asyncio
 import logging
-from typing import Dict, List, Optional
+import multiprocessing
+from typing import Dict, List, Optional, Tuple
 import tempfile
+from abc import ABC, abstractmethod
+import time
 import shutil
-from urllib.parse import urlparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from urllib.parse import parse_qsl, urlencode, urlparse, urlsplit, urlunsplit
 
+import orjson
+import msgpack
+import redis.asyncio as redis
 import yt_dlp
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from cachetools import TTLCache
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile, Message
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, 
     CallbackQueryHandler, ContextTypes, filters
 )
+from telegram.request import HTTPXRequest
 
 # Configure logging
 logging.basicConfig(
@@ -23,70 +34,371 @@ logger = logging.getLogger(__name__)
 # Bot configuration
 BOT_TOKEN = "YOUR_BOT_TOKEN_HERE"  # Replace with your actual bot token
 MAX_FILE_SIZE = 2 * 1024 * 1024 * 1024  # 500MB extended file size limit
+MAX_SESSIONS = 10_000  # Upper bound on concurrently stored user sessions
+SESSION_TTL = 600  # Seconds before an abandoned session expires
+MAX_CONCURRENT_DOWNLOADS = 4  # Downloads beyond this wait in a queue
+IO_WORKERS = 8  # Threads for blocking file operations (temp dirs, stat)
+# Extraction processes, each a full interpreter importing this module. CPU
+# affinity ignores cgroup quotas (e.g. Docker --cpus), so a many-core host
+# would still get one worker per core; cap it and allow an env override.
+EXTRACT_WORKERS = int(os.environ.get("EXTRACT_WORKERS", min(4, (
+    len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+))))
+INFO_CACHE_SIZE = 1024  # Number of extracted video infos kept for repeat URLs
+INFO_CACHE_TTL = 300  # Seconds an extracted video info stays cached
+STATUS_UPDATE_INTERVAL = 2.0  # Minimum seconds between intermediate status edits
+REDIS_URL = os.environ.get("REDIS_URL")  # Shared session store; in-memory sessions when unset
+
+# Webhook configuration; the bot falls back to long polling when WEBHOOK_URL is unset
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")  # Public HTTPS URL Telegram pushes updates to
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")  # Verifies requests really come from Telegram
+WEBHOOK_PORT = int(os.environ.get("PORT", 8443))
+WEBHOOK_MAX_CONNECTIONS = 100  # Concurrent connections Telegram may open to deliver updates
+
+# Platforms that usually expose a single stream, skipping quality selection
+_SINGLE_STREAM_PLATFORMS = frozenset({'TikTok', 'Twitter/X'})
+
+# File extensions sent with reply_audio instead of reply_video
+_AUDIO_EXTS = frozenset({'.mp3', '.m4a', '.wav', '.flac', '.ogg', '.opus'})
+
+# The only yt-dlp info and per-format fields the bot reads after extraction
+_INFO_KEYS = ('title', 'duration')
+_FORMAT_KEYS = ('format_id', 'ext', 'height', 'abr', 'acodec', 'vcodec', 'filesize', 'filesize_approx')
+
+def _slim_info(info: Dict) -> Dict:
+    """Keep only the whitelisted fields of a yt-dlp info dict"""
+    slim = {k: info[k] for k in _INFO_KEYS if k in info}
+    slim['formats'] = [
+        {k: f[k] for k in _FORMAT_KEYS if k in f}
+        for f in info.get('formats') or []
+    ]
+    return slim
+
+# Supported domains mapped to platform names; subdomains match by suffix
+_PLATFORM_MAP = {
+    'youtube.com': 'YouTube',
+    'youtu.be': 'YouTube',
+    'twitter.com': 'Twitter/X',
+    'x.com': 'Twitter/X',
+    'tiktok.com': 'TikTok',
+    'newgrounds.com': 'Newgrounds'
+}
+
+@lru_cache(maxsize=4096)
+def _platform_for_url(url: str) -> Optional[str]:
+    """Resolve a URL to its platform name, walking up the domain labels"""
+    domain = urlparse(url).netloc.lower().rsplit('@', 1)[-1].split(':')[0]
+    
+    # Try "m.youtube.com", then "youtube.com", ... so each label costs one dict lookup
+    while domain:
+        platform = _PLATFORM_MAP.get(domain)
+        if platform:
+            return platform
+        _, _, domain = domain.partition('.')
+    return None
+
+# Base yt-dlp options for each kind of job; per-call values are set on the instance
+_YDL_OPTS = {
+    'info': {
+        'quiet': True,
+        'no_warnings': True,
+        'extract_flat': False,
+    },
+    'download': {
+        'outtmpl': '%(title)s.%(ext)s',
+        'quiet': True,
+        'no_warnings': True,
+        # Fetch HLS/DASH fragments in parallel and request plain HTTP
+        # downloads in 10MB chunks to avoid per-connection throttling
+        'concurrent_fragment_downloads': 8,
+        'http_chunk_size': 10 * 1024 * 1024,
+        'retries': 3,
+        'fragment_retries': 10,
+    },
+}
+
+# Per-process YoutubeDL used by _extract_info inside the extraction pool workers
+_worker_ydl: Optional[yt_dlp.YoutubeDL] = None
+
+def _extract_info(url: str) -> Dict:
+    """Extract video info in a pool worker and return a slimmed, picklable dict"""
+    global _worker_ydl
+    if _worker_ydl is None:
+        _worker_ydl = yt_dlp.YoutubeDL(dict(_YDL_OPTS['info']))
+    
+    try:
+        info = _worker_ydl.extract_info(url, download=False)
+    except Exception as e:
+        # yt-dlp errors carry tracebacks that can't be pickled back to the bot
+        raise RuntimeError(str(e)) from None
+    return _slim_info(info)
+
+# Query parameters that only track sharing and never change the media
+_TRACKING_PARAMS = frozenset({
+    'si', 'feature', 'fbclid', 'igshid', 'ref_src', 'ref_url',
+    'is_from_webapp', 'sender_device', 'share_app_id',
+})
+
+def _normalize_url(url: str) -> str:
+    """Strip tracking parameters and fragments so shared links map to one cache key"""
+    parts = urlsplit(url.strip())
+    query = [
+        (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+        if k not in _TRACKING_PARAMS and not k.startswith('utm_')
+    ]
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, urlencode(query), ''))
 
 class MediaDownloader:
     def __init__(self):
-        self.supported_platforms = {
-            'youtube.com': 'YouTube',
-            'youtu.be': 'YouTube',
-            'twitter.com': 'Twitter/X',
-            'x.com': 'Twitter/X',
-            'tiktok.com': 'TikTok',
-            'newgrounds.com': 'Newgrounds'
-        }
+        # Extraction parses HTML/JSON while holding the GIL, so run it in
+        # separate processes to let concurrent lookups use every core
+        self._extract_pool = self._new_extract_pool()
+        # Downloads get their own threads so they never queue behind, or
+        # starve, other blocking work in the default executor
+        self._download_pool = ThreadPoolExecutor(
+            max_workers=MAX_CONCURRENT_DOWNLOADS,
+            thread_name_prefix="ytdl-download"
+        )
+        # Idle download YoutubeDL instances, reused so extractors, cookies and
+        # the HTTP connection pool survive between requests. Each instance is
+        # checked out by one job at a time since yt-dlp state is not thread-safe.
+        self._idle_ydl: List[yt_dlp.YoutubeDL] = []
+        # Recently extracted info by normalized URL, plus in-flight extractions
+        self._info_cache = TTLCache(maxsize=INFO_CACHE_SIZE, ttl=INFO_CACHE_TTL)
+        self._pending_info: Dict[str, asyncio.Future] = {}
     
     def get_platform(self, url: str) -> Optional[str]:
         """Identify the platform from URL"""
-        parsed = urlparse(url)
-        domain = parsed.netloc.lower().replace('www.', '')
-        
-        for platform_domain, platform_name in self.supported_platforms.items():
-            if platform_domain in domain:
-                return platform_name
-        return None
+        return _platform_for_url(url)
+    
+    @staticmethod
+    def _new_extract_pool() -> ProcessPoolExecutor:
+        """Create the process pool used for info extraction"""
+        return ProcessPoolExecutor(
+            max_workers=EXTRACT_WORKERS,
+            mp_context=multiprocessing.get_context('spawn')
+        )
+    
+    def _acquire_ydl(self) -> yt_dlp.YoutubeDL:
+        """Check out an idle download YoutubeDL instance, creating one if none is free"""
+        if self._idle_ydl:
+            return self._idle_ydl.pop()
+        return yt_dlp.YoutubeDL(dict(_YDL_OPTS['download']))
+    
+    def _release_ydl(self, ydl: yt_dlp.YoutubeDL):
+        """Return a download YoutubeDL instance to the idle pool"""
+        self._idle_ydl.append(ydl)
+    
+    def close(self):
+        """Stop the worker pools and close all pooled YoutubeDL instances"""
+        self._extract_pool.shutdown(wait=False, cancel_futures=True)
+        self._download_pool.shutdown(wait=False, cancel_futures=True)
+        while self._idle_ydl:
+            self._idle_ydl.pop().close()
     
     async def get_video_info(self, url: str) -> Dict:
         """Extract video information without downloading"""
-        ydl_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'extract_flat': False,
-        }
+        key = _normalize_url(url)
+        info = self._info_cache.get(key)
+        if info is not None:
+            return info
         
+        # Concurrent requests for the same URL share a single extraction
+        pending = self._pending_info.get(key)
+        if pending is None:
+            pending = asyncio.ensure_future(self._fetch_video_info(url, key))
+            self._pending_info[key] = pending
+            pending.add_done_callback(lambda _: self._pending_info.pop(key, None))
+        return await asyncio.shield(pending)
+    
+    async def _fetch_video_info(self, url: str, key: str) -> Dict:
+        """Run the extraction and cache successful results under key"""
+        loop = asyncio.get_running_loop()
         try:
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = await asyncio.to_thread(ydl.extract_info, url, download=False)
-                return info
+            pool = self._extract_pool
+            try:
+                info = await loop.run_in_executor(pool, _extract_info, url)
+            except BrokenProcessPool:
+                # A dead worker breaks the pool for good; swap in a fresh one
+                # (unless a concurrent lookup already did) and retry once
+                logger.warning("Extraction pool broke, restarting it")
+                if self._extract_pool is pool:
+                    self._extract_pool = self._new_extract_pool()
+                    pool.shutdown(wait=False, cancel_futures=True)
+                info = await loop.run_in_executor(self._extract_pool, _extract_info, url)
         except Exception as e:
             logger.error(f"Error extracting info: {e}")
             return {}
+        
+        self._info_cache[key] = info
+        return info
     
     async def download_media(self, url: str, format_id: str, output_path: str) -> Optional[str]:
         """Download media with specified format"""
-        ydl_opts = {
-            'outtmpl': os.path.join(output_path, '%(title)s.%(ext)s'),
-            'format': format_id,
-            'quiet': True,
-            'no_warnings': True,
-        }
-        
+        ydl = self._acquire_ydl()
         try:
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = await asyncio.to_thread(ydl.extract_info, url)
-                filename = ydl.prepare_filename(info)
-                return filename if os.path.exists(filename) else None
+            # The format selector is compiled at construction, so rebuild it here
+            ydl.params['paths'] = {'home': output_path}
+            ydl.params['format'] = format_id
+            ydl.format_selector = ydl.build_format_selector(format_id)
+            
+            loop = asyncio.get_running_loop()
+            info = await loop.run_in_executor(self._download_pool, ydl.extract_info, url)
+            # Existence is checked by the caller's stat of the returned path
+            return ydl.prepare_filename(info)
         except Exception as e:
             logger.error(f"Download error: {e}")
             return None
+        finally:
+            self._release_ydl(ydl)
 
-class TelegramBot:
-    def __init__(self):
-        self.downloader = MediaDownloader()
-        self.user_sessions = {}  # Store user session data
+class AbstractSessionStore(ABC):
+    """Async per-user session storage"""
     
-    async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Handle /start command"""
-        welcome_text = """
+    @abstractmethod
+    async def get(self, user_id: int) -> Optional[Dict]:
+        """Return the user's session, or None if there is none"""
+    
+    @abstractmethod
+    async def set(self, user_id: int, session: Dict):
+        """Store the user's session, replacing any existing one"""
+    
+    @abstractmethod
+    async def delete(self, user_id: int) -> bool:
+        """Remove the user's session and report whether one existed"""
+    
+    @abstractmethod
+    async def pop(self, user_id: int) -> Optional[Dict]:
+        """Atomically remove and return the user's session, or None if there is none"""
+    
+    async def close(self):
+        """Release any resources held by the store"""
+
+class MemorySessionStore(AbstractSessionStore):
+    """In-process session store; sessions are lost on restart"""
+    
+    def __init__(self, maxsize: int = MAX_SESSIONS, ttl: int = SESSION_TTL):
+        self._sessions = TTLCache(maxsize=maxsize, ttl=ttl)
+    
+    async def get(self, user_id: int) -> Optional[Dict]:
+        return self._sessions.get(user_id)
+    
+    async def set(self, user_id: int, session: Dict):
+        self._sessions[user_id] = session
+    
+    async def delete(self, user_id: int) -> bool:
+        return self._sessions.pop(user_id, None) is not None
+    
+    async def pop(self, user_id: int) -> Optional[Dict]:
+        return self._sessions.pop(user_id, None)
+
+class RedisSessionStore(AbstractSessionStore):
+    """Redis-backed session store shared by every bot instance, msgpack-encoded"""
+    
+    def __init__(self, url: str, ttl: int = SESSION_TTL, prefix: str = "matthew-bot:session:"):
+        self._redis = redis.from_url(url)
+        self._ttl = ttl
+        self._prefix = prefix
+    
+    def _key(self, user_id: int) -> str:
+        return f"{self._prefix}{user_id}"
+    
+    async def get(self, user_id: int) -> Optional[Dict]:
+        data = await self._redis.get(self._key(user_id))
+        return msgpack.unpackb(data) if data is not None else None
+    
+    async def set(self, user_id: int, session: Dict):
+        await self._redis.set(self._key(user_id), msgpack.packb(session), ex=self._ttl)
+    
+    async def delete(self, user_id: int) -> bool:
+        return bool(await self._redis.delete(self._key(user_id)))
+    
+    async def pop(self, user_id: int) -> Optional[Dict]:
+        data = await self._redis.getdel(self._key(user_id))
+        return msgpack.unpackb(data) if data is not None else None
+    
+    async def close(self):
+        await self._redis.aclose()
+
+class _StatusThrottle:
+    """Edits a status message at most once per interval; final states always go through.
+    
+    Intermediate states arriving too soon are deferred, not dropped: the newest
+    one is shown as soon as the interval has passed. Edits are applied one at a
+    time, and nothing is shown after the final state.
+    """
+    
+    def __init__(self, edit, interval: float = STATUS_UPDATE_INTERVAL):
+        self._edit = edit
+        self._interval = interval
+        self._last_text: Optional[str] = None
+        self._last_time: Optional[float] = None
+        self._pending_text: Optional[str] = None
+        # Set only while the flush is still sleeping, so cancelling it never
+        # interrupts an edit that is already on the wire
+        self._pending_flush: Optional[asyncio.Task] = None
+        self._edit_lock = asyncio.Lock()
+        self._finished = False
+    
+    async def update(self, text: str, final: bool = False):
+        """Show text now, or schedule it if the last edit was too recent"""
+        if final:
+            # The final state supersedes anything still waiting; an in-flight
+            # flush is waited for by _show's lock instead
+            if self._pending_flush is not None:
+                self._pending_flush.cancel()
+                self._pending_flush = None
+        elif self._pending_flush is not None:
+            # A flush is already scheduled and will pick up the newest text
+            self._pending_text = text
+            return
+        
+        if text == self._last_text:
+            return
+        
+        if not final and self._last_time is not None:
+            delay = self._interval - (time.monotonic() - self._last_time)
+            if delay > 0:
+                self._pending_text = text
+                self._pending_flush = asyncio.create_task(self._flush_after(delay))
+                return
+        
+        await self._show(text, final)
+    
+    async def _flush_after(self, delay: float):
+        """Show the newest deferred text once the interval has passed"""
+        await asyncio.sleep(delay)
+        self._pending_flush = None
+        if self._pending_text != self._last_text:
+            try:
+                await self._show(self._pending_text)
+            except Exception as e:
+                logger.warning(f"Status update failed: {e}")
+    
+    async def _show(self, text: str, final: bool = False):
+        # Serialise edits so a slow intermediate edit can't land after the final one
+        async with self._edit_lock:
+            if self._finished:
+                return
+            self._finished = final
+            self._last_text = text
+            self._last_time = time.monotonic()
+            await self._edit(text)
+
+class _OrjsonRequest(HTTPXRequest):
+    """HTTPXRequest that decodes Telegram responses with orjson"""
+    
+    @staticmethod
+    def parse_json_payload(payload: bytes) -> Dict:
+        """Parse a response body, deferring to PTB's lenient parser if orjson rejects it"""
+        try:
+            return orjson.loads(payload)
+        except orjson.JSONDecodeError:
+            # PTB replaces invalid UTF-8 and raises TelegramError for broken JSON
+            return HTTPXRequest.parse_json_payload(payload)
+
+# Static command replies, built once at import
+_WELCOME = """
 🤖 **Matthew Bot - Multi-Platform Media Downloader**
 
 Send me a URL from:
@@ -102,12 +414,9 @@ I'll extract available formats and let you choose quality and format!
 /cancel - Cancel current operation
 
 Just paste a URL to get started! 🚀
-        """
-        await update.message.reply_text(welcome_text, parse_mode='Markdown')
-    
-    async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Handle /help command"""
-        help_text = """
+""".strip()
+
+_HELP = """
 **How to use:**
 
 1. Send me a URL from supported platforms
@@ -125,14 +434,60 @@ Just paste a URL to get started! 🚀
 **Supported formats:** MP4, MP3, WEBM, M4A, and more!
 
 Note: Some platforms may have restrictions on certain content.
-        """
-        await update.message.reply_text(help_text, parse_mode='Markdown')
+""".strip()
+
+# Keyboards that never change, built once at import (PTB markup objects are immutable)
+_FORMAT_KEYBOARD = InlineKeyboardMarkup([
+    # Audio formats
+    [InlineKeyboardButton("🎵 Audio Only", callback_data="category_audio")],
+    # Video formats
+    [InlineKeyboardButton("🎬 Video", callback_data="category_video")],
+    # Cancel button
+    [InlineKeyboardButton("❌ Cancel", callback_data="cancel")]
+])
+
+# Back and Cancel row appended to every quality keyboard
+_NAV_ROW = (
+    InlineKeyboardButton("⬅ Back", callback_data="back"),
+    InlineKeyboardButton("❌ Cancel", callback_data="cancel")
+)
+
+class TelegramBot:
+    def __init__(self):
+        self.downloader = MediaDownloader()
+        # Store user session data; abandoned sessions expire after SESSION_TTL.
+        # Redis lets several bot instances share sessions and survive restarts.
+        self._sessions: AbstractSessionStore = (
+            RedisSessionStore(REDIS_URL) if REDIS_URL else MemorySessionStore()
+        )
+        # Caps simultaneous yt-dlp downloads across all users
+        self._download_slots = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+        # Small pool for temp dir and stat calls, kept apart from downloads
+        self._io_pool = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="io")
+    
+    async def shutdown(self, application: Application):
+        """Release downloader and session store resources when the application stops"""
+        self.downloader.close()
+        self._io_pool.shutdown(wait=False)
+        await self._sessions.close()
+    
+    async def _run_io(self, func, *args):
+        """Run a blocking file operation on the I/O thread pool"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._io_pool, func, *args)
+    
+    async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle /start command"""
+        await update.message.reply_text(_WELCOME, parse_mode='Markdown')
+    
+    async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle /help command"""
+        await update.message.reply_text(_HELP, parse_mode='Markdown')
     
     async def cancel_operation(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /cancel command"""
         user_id = update.effective_user.id
-        if user_id in self.user_sessions:
-            del self.user_sessions[user_id]
+        if await self._sessions.delete(user_id):
             await update.message.reply_text("❌ Operation cancelled.")
         else:
             await update.message.reply_text("No operation to cancel.")
@@ -163,15 +518,23 @@ Note: Some platforms may have restrictions on certain content.
                 await processing_msg.edit_text("❌ Failed to extract video information.")
                 return
             
-            # Store session data
-            self.user_sessions[user_id] = {
+            session = {
                 'url': url,
-                'info': info,
+                'title': info.get('title', 'Unknown Title'),
                 'platform': platform
             }
             
+            # Single-stream sources leave nothing to choose, so download right away
+            if platform in _SINGLE_STREAM_PLATFORMS and len(info.get('formats', [])) <= 2:
+                await self.download_and_send(processing_msg, session, 'best')
+                return
+            
+            # Store session data; only the precomputed quality options are kept
+            session['options'] = self._partition_formats(info)
+            await self._sessions.set(user_id, session)
+            
             # Create format selection keyboard
-            keyboard = self.create_format_keyboard(info)
+            keyboard = self.create_format_keyboard()
             
             title = info.get('title', 'Unknown Title')[:50]
             duration = info.get('duration', 0)
@@ -194,71 +557,53 @@ Note: Some platforms may have restrictions on certain content.
                 "❌ Error processing URL. Please try again or check if the URL is valid."
             )
     
-    def create_format_keyboard(self, info: Dict) -> InlineKeyboardMarkup:
+    def create_format_keyboard(self) -> InlineKeyboardMarkup:
         """Create inline keyboard for format selection"""
-        keyboard = []
-        
-        # Audio formats
-        keyboard.append([InlineKeyboardButton("🎵 Audio Only", callback_data="category_audio")])
+        return _FORMAT_KEYBOARD
+    
+    def _partition_formats(self, info: Dict) -> Dict[str, List[Tuple[str, str]]]:
+        """Build the audio and video quality options in a single pass over formats"""
+        audio_formats = []
+        video_formats = []
         
-        # Video formats
-        keyboard.append([InlineKeyboardButton("🎬 Video", callback_data="category_video")])
+        for f in info.get('formats', []):
+            ext = f.get('ext', 'unknown')
+            filesize = f.get('filesize') or f.get('filesize_approx', 0)
+            if not filesize or filesize > MAX_FILE_SIZE:
+                continue
+            size_mb = filesize / (1024 * 1024)
+            
+            if f.get('vcodec') != 'none':
+                # Video formats
+                height = f.get('height', 0)
+                if height:
+                    button_text = f"📹 {height}p {ext.upper()} ({size_mb:.1f}MB)"
+                    video_formats.append((button_text, f['format_id'], height))
+            elif f.get('acodec') != 'none':
+                # Audio formats
+                quality = f.get('abr', 'Unknown')
+                button_text = f"🎵 {ext.upper()} - {quality}kbps ({size_mb:.1f}MB)"
+                audio_formats.append((button_text, f['format_id'], f.get('abr') or 0))
         
-        # Cancel button
-        keyboard.append([InlineKeyboardButton("❌ Cancel", callback_data="cancel")])
+        # Sort by quality (descending)
+        audio_formats.sort(key=lambda x: x[2], reverse=True)
+        video_formats.sort(key=lambda x: x[2], reverse=True)
         
-        return InlineKeyboardMarkup(keyboard)
+        # Limit to 5 options each
+        return {
+            'audio': [(text, format_id) for text, format_id, _ in audio_formats[:5]],
+            'video': [(text, format_id) for text, format_id, _ in video_formats[:5]],
+        }
     
-    def create_quality_keyboard(self, info: Dict, category: str) -> InlineKeyboardMarkup:
+    def create_quality_keyboard(self, options: Dict, category: str) -> InlineKeyboardMarkup:
         """Create keyboard for quality selection"""
-        keyboard = []
-        formats = info.get('formats', [])
-        
-        if category == "audio":
-            # Audio formats
-            audio_formats = []
-            for f in formats:
-                if f.get('acodec') != 'none' and f.get('vcodec') == 'none':
-                    quality = f.get('abr', 'Unknown')
-                    ext = f.get('ext', 'unknown')
-                    filesize = f.get('filesize') or f.get('filesize_approx', 0)
-                    
-                    if filesize and filesize <= MAX_FILE_SIZE:
-                        size_mb = filesize / (1024 * 1024)
-                        button_text = f"🎵 {ext.upper()} - {quality}kbps ({size_mb:.1f}MB)"
-                        audio_formats.append((button_text, f['format_id']))
-            
-            # Sort by quality (descending)
-            audio_formats.sort(key=lambda x: x[1], reverse=True)
-            
-            for text, format_id in audio_formats[:5]:  # Limit to 5 options
-                keyboard.append([InlineKeyboardButton(text, callback_data=f"download_{format_id}")])
-        
-        elif category == "video":
-            # Video formats
-            video_formats = []
-            for f in formats:
-                if f.get('vcodec') != 'none':
-                    height = f.get('height', 0)
-                    ext = f.get('ext', 'unknown')
-                    filesize = f.get('filesize') or f.get('filesize_approx', 0)
-                    
-                    if filesize and filesize <= MAX_FILE_SIZE and height:
-                        size_mb = filesize / (1024 * 1024)
-                        button_text = f"📹 {height}p {ext.upper()} ({size_mb:.1f}MB)"
-                        video_formats.append((button_text, f['format_id'], height))
-            
-            # Sort by resolution (descending)
-            video_formats.sort(key=lambda x: x[2], reverse=True)
-            
-            for text, format_id, _ in video_formats[:5]:  # Limit to 5 options
-                keyboard.append([InlineKeyboardButton(text, callback_data=f"download_{format_id}")])
+        keyboard = [
+            [InlineKeyboardButton(text, callback_data=f"download_{format_id}")]
+            for text, format_id in options.get(category, [])
+        ]
         
         # Back and Cancel buttons
-        keyboard.append([
-            InlineKeyboardButton("⬅ Back", callback_data="back"),
-            InlineKeyboardButton("❌ Cancel", callback_data="cancel")
-        ])
+        keyboard.append(_NAV_ROW)
         
         return InlineKeyboardMarkup(keyboard)
     
@@ -271,98 +616,110 @@ Note: Some platforms may have restrictions on certain content.
         data = query.data
         
         if data == "cancel":
-            if user_id in self.user_sessions:
-                del self.user_sessions[user_id]
+            await self._sessions.delete(user_id)
             await query.edit_message_text("❌ Operation cancelled.")
             return
         
-        if user_id not in self.user_sessions:
+        session = await self._sessions.get(user_id)
+        if session is None:
             await query.edit_message_text("❌ Session expired. Please send the URL again.")
             return
         
-        session = self.user_sessions[user_id]
-        info = session['info']
-        
         if data == "back":
             # Go back to format selection
-            keyboard = self.create_format_keyboard(info)
-            title = info.get('title', 'Unknown Title')[:50]
+            keyboard = self.create_format_keyboard()
+            title = session['title'][:50]
             text = f"📹 **{title}**\n\nChoose format and quality:"
             await query.edit_message_text(text, reply_markup=keyboard, parse_mode='Markdown')
         
         elif data.startswith("category_"):
             category = data.replace("category_", "")
-            keyboard = self.create_quality_keyboard(info, category)
-            title = info.get('title', 'Unknown Title')[:50]
+            keyboard = self.create_quality_keyboard(session['options'], category)
+            title = session['title'][:50]
             category_name = "Audio" if category == "audio" else "Video"
             text = f"📹 **{title}**\n\nSelect {category_name} quality:"
             await query.edit_message_text(text, reply_markup=keyboard, parse_mode='Markdown')
         
         elif data.startswith("download_"):
             format_id = data.replace("download_", "")
-            await self.download_and_send(query, session, format_id)
+            # Atomically claim the session before downloading, so a repeated tap
+            # handled concurrently can't start the same download twice, and a
+            # URL sent in the meantime is what gets downloaded rather than lost
+            session = await self._sessions.pop(user_id)
+            if session is None:
+                await query.edit_message_text("❌ Session expired. Please send the URL again.")
+                return
+            await self.download_and_send(query.message, session, format_id)
     
-    async def download_and_send(self, query, session: Dict, format_id: str):
-        """Download and send the media file"""
-        await query.edit_message_text("⬇️ Downloading... Please wait.")
-        
+    async def download_and_send(self, message: Message, session: Dict, format_id: str):
+        """Download and send the media file, reporting progress by editing message"""
         url = session['url']
-        info = session['info']
+        status = _StatusThrottle(message.edit_text)
         
         # Create temporary directory
-        temp_dir = tempfile.mkdtemp()
+        temp_dir = await self._run_io(tempfile.mkdtemp)
         
         try:
-            # Download the file
-            filepath = await self.downloader.download_media(url, format_id, temp_dir)
+            # Download the file, waiting for a free slot if too many are running
+            if self._download_slots.locked():
+                await status.update("⏳ Queued... Other downloads are in progress.")
+            async with self._download_slots:
+                await status.update("⬇️ Downloading... Please wait.")
+                filepath = await self.downloader.download_media(url, format_id, temp_dir)
             
-            if not filepath or not os.path.exists(filepath):
-                await query.edit_message_text("❌ Download failed. Please try again.")
+            # A single stat off the event loop gives both existence and size
+            file_size = None
+            if filepath:
+                try:
+                    file_size = (await self._run_io(os.stat, filepath)).st_size
+                except FileNotFoundError:
+                    pass
+            
+            if file_size is None:
+                await status.update("❌ Download failed. Please try again.", final=True)
                 return
             
             # Check file size
-            file_size = os.path.getsize(filepath)
             if file_size > MAX_FILE_SIZE:
-                await query.edit_message_text(
+                await status.update(
                     f"❌ File too large ({file_size/(1024*1024):.1f}MB). "
-                    f"Maximum allowed size is {MAX_FILE_SIZE/(1024*1024):.0f}MB."
+                    f"Maximum allowed size is {MAX_FILE_SIZE/(1024*1024):.0f}MB.",
+                    final=True
                 )
                 return
             
-            await query.edit_message_text("📤 Uploading to Telegram...")
+            await status.update("📤 Uploading to Telegram...")
             
             # Send the file
-            title = info.get('title', 'download')
+            title = session['title']
             caption = f"🎬 {title}\n🔗 From: {session['platform']}"
             
+            # Hand the open file to httpx so it is streamed in chunks instead of
+            # being read into memory up front
             with open(filepath, 'rb') as file:
-                if filepath.lower().endswith(('.mp3', '.m4a', '.wav', '.flac')):
-                    await query.message.reply_audio(
-                        audio=file,
+                media = InputFile(file, filename=os.path.basename(filepath), read_file_handle=False)
+                if os.path.splitext(filepath)[1].lower() in _AUDIO_EXTS:
+                    await message.reply_audio(
+                        audio=media,
                         caption=caption,
                         title=title
                     )
                 else:
-                    await query.message.reply_video(
-                        video=file,
+                    await message.reply_video(
+                        video=media,
                         caption=caption
                     )
             
-            await query.edit_message_text("✅ Download completed!")
+            await status.update("✅ Download completed!", final=True)
             
         except Exception as e:
             logger.error(f"Download error: {e}")
-            await query.edit_message_text("❌ Download failed. Please try again.")
+            await status.update("❌ Download failed. Please try again.", final=True)
         
         finally:
-            # Cleanup
-            if os.path.exists(temp_dir):
-                shutil.rmtree(temp_dir, ignore_errors=True)
-            
-            # Clear session
-            user_id = query.from_user.id
-            if user_id in self.user_sessions:
-                del self.user_sessions[user_id]
+            # Cleanup; removing many fragment files can take a while, so keep
+            # it off the event loop
+            await self._run_io(shutil.rmtree, temp_dir, True)
 
 def main():
     """Main function to run the bot"""
@@ -373,8 +730,17 @@ def main():
     # Create bot instance
     bot = TelegramBot()
     
-    # Create application
-    application = Application.builder().token(BOT_TOKEN).build()
+    # Create application with a connection pool large enough for bursts of
+    # callbacks and uploads, multiplexed over HTTP/2 connections to Telegram
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .request(_OrjsonRequest(connection_pool_size=256, pool_timeout=30, http_version="2"))
+        .get_updates_request(_OrjsonRequest(connection_pool_size=32, http_version="2"))
+        .concurrent_updates(True)
+        .post_shutdown(bot.shutdown)
+        .build()
+    )
     
     # Add handlers
     application.add_handler(CommandHandler("start", bot.start))
@@ -385,7 +751,19 @@ def main():
     
     # Start the bot
     print("🚀 Bot is starting...")
-    application.run_polling()
+    if WEBHOOK_URL:
+        # Telegram pushes updates over parallel connections instead of us polling
+        application.run_webhook(
+            listen='0.0.0.0',
+            port=WEBHOOK_PORT,
+            # Serve on the same path Telegram will POST to
+            url_path=urlparse(WEBHOOK_URL).path.lstrip('/'),
+            webhook_url=WEBHOOK_URL,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            secret_token=WEBHOOK_SECRET
+        )
+    else:
+        application.run_polling()
 
 if __name__ == '__main__':
     main()